@@ -1,16 +1,34 @@
 import os
-import json
+import shutil
+import asyncio
 from datetime import date
+from concurrent.futures import ThreadPoolExecutor
 
-from flask import Flask, render_template, request, jsonify
+from quart import Quart, render_template, request, jsonify
 from dotenv import load_dotenv
-
-from imdb_parser import parse_imdb_csv
-from tmdb_api import get_providers_fresh, get_providers_cached, sql_delete
+import orjson
+
+from imdb_parser import parse_imdb_csv, parse_imdb_ids
+from tmdb_api import (
+    process_all,
+    sql_load_many,
+    sql_save_many,
+    sql_delete_many,
+    sql_delete_all,
+    sql_has_rows,
+    sql_indexed_watchlists,
+    sql_watchlist_ids,
+    sql_shared_ids,
+    sql_set_watchlist_ids,
+    sql_delete_watchlist_ids,
+    sql_load_watchlist_regions,
+    sql_save_watchlist_regions,
+    sql_delete_watchlist_regions,
+)
 
 load_dotenv()
 
-app = Flask(__name__)
+app = Quart(__name__)
 app.config["UPLOAD_FOLDER"] = "uploads"
 
 
@@ -18,35 +36,92 @@ app.config["UPLOAD_FOLDER"] = "uploads"
 # Watchlist metadata helpers
 # ============================================================
 
-def _watchlist_meta_path(csv_filename: str) -> str:
+def _is_plain_filename(name: str) -> bool:
+    """Reject names that would reach outside the upload folder."""
+    return name == os.path.basename(name) and name not in (".", "..")
+
+
+def load_watchlist_meta(csv_filename: str) -> dict:
+    return {
+        "filename": csv_filename,
+        "regions": sql_load_watchlist_regions(csv_filename)
+    }
+
+
+def save_watchlist_meta(csv_filename: str, meta: dict) -> None:
+    sql_save_watchlist_regions(csv_filename, meta.get("regions", {}))
+
+
+def migrate_legacy_meta() -> None:
     """
-    Store watchlist-level metadata next to the CSV, as:
-        uploads/<csv_filename>.json
+    Import any legacy uploads/<csv_filename>.json metadata files into the
+    watchlist_regions table, then remove them. Run once at startup, so no
+    request path needs to know about these files.
     """
-    return os.path.join(app.config["UPLOAD_FOLDER"], f"{csv_filename}.json")
+    folder = app.config["UPLOAD_FOLDER"]
+    if not os.path.isdir(folder):
+        return
 
+    with os.scandir(folder) as it:
+        legacy = [e for e in it if e.is_file() and e.name.lower().endswith(".csv.json")]
 
-def load_watchlist_meta(csv_filename: str) -> dict:
-    path = _watchlist_meta_path(csv_filename)
-    if not os.path.exists(path):
-        return {"filename": csv_filename, "regions": {}}
+    for entry in legacy:
+        csv_filename = entry.name[:-len(".json")]
+        try:
+            with open(entry.path, "rb") as f:
+                data = orjson.loads(f.read())
+        except (OSError, orjson.JSONDecodeError):
+            continue
 
-    with open(path, "r", encoding="utf-8") as f:
-        data = json.load(f)
+        regions = data.get("regions") if isinstance(data, dict) else None
+        if isinstance(regions, dict) and not sql_load_watchlist_regions(csv_filename):
+            sql_save_watchlist_regions(csv_filename, regions)
+        os.remove(entry.path)
 
-    if "regions" not in data or not isinstance(data["regions"], dict):
-        data["regions"] = {}
-    if "filename" not in data:
-        data["filename"] = csv_filename
 
-    return data
+@app.before_serving
+async def startup() -> None:
+    await asyncio.to_thread(migrate_legacy_meta)
 
 
-def save_watchlist_meta(csv_filename: str, meta: dict) -> None:
-    meta.setdefault("filename", csv_filename)
-    path = _watchlist_meta_path(csv_filename)
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(meta, f, ensure_ascii=False, indent=4)
+def sync_watchlist_index() -> None:
+    """
+    Make the watchlist_ids table match the CSVs in the upload folder:
+    index any CSV not yet recorded (e.g. uploaded before the table existed)
+    and drop rows for CSVs that no longer exist.
+    """
+    folder = app.config["UPLOAD_FOLDER"]
+    with os.scandir(folder) as it:
+        on_disk = {e.name for e in it if e.is_file() and e.name.endswith(".csv")}
+    indexed = sql_indexed_watchlists()
+
+    for wl in indexed - on_disk:
+        sql_delete_watchlist_ids(wl)
+
+    missing = sorted(on_disk - indexed)
+    if not missing:
+        return
+
+    def read_ids(wl):
+        try:
+            return wl, parse_imdb_ids(os.path.join(folder, wl))
+        except Exception:
+            return wl, None
+
+    # Reading the CSVs is I/O-bound, so overlap it across a few threads
+    with ThreadPoolExecutor(max_workers=min(8, len(missing))) as ex:
+        for wl, imdb_ids in ex.map(read_ids, missing):
+            if imdb_ids is not None:
+                sql_set_watchlist_ids(wl, imdb_ids)
+
+
+def lookup_watchlist_ids(filename: str) -> tuple[list, set]:
+    """
+    (imdb_ids in this watchlist, those also in other watchlists), after
+    bringing the index up to date. Blocking: call via asyncio.to_thread.
+    """
+    sync_watchlist_index()
+    return sql_watchlist_ids(filename), sql_shared_ids(filename)
 
 
 # ============================================================
@@ -54,32 +129,24 @@ def save_watchlist_meta(csv_filename: str, meta: dict) -> None:
 # ============================================================
 
 @app.route("/")
-def index():
-    os.makedirs(app.config["UPLOAD_FOLDER"], exist_ok=True)
-    files = os.listdir(app.config["UPLOAD_FOLDER"])
-
-    # CSV files
-    existing_files = [f for f in files if f.lower().endswith(".csv")]
-
-    # Metadata JSON files
-    meta_files = [f for f in files if f.lower().endswith(".json")]
-
-    # SQL rows exist?
-    import sqlite3
-    conn = sqlite3.connect("cache.db")
-    c = conn.cursor()
-    c.execute("SELECT COUNT(*) FROM film_cache")
-    db_count = c.fetchone()[0]
-    conn.close()
-
-    # Show button if ANY data exists anywhere
-    show_delete_all = (
-        len(existing_files) > 0 or
-        len(meta_files) > 0 or
-        db_count > 0
-    )
+async def index():
+    def scan():
+        os.makedirs(app.config["UPLOAD_FOLDER"], exist_ok=True)
+
+        # CSV files, in one pass over the folder
+        with os.scandir(app.config["UPLOAD_FOLDER"]) as it:
+            existing_files = [
+                entry.name for entry in it
+                if entry.is_file() and entry.name.lower().endswith(".csv")
+            ]
+
+        # Show button if ANY data exists anywhere (SQL only checked if needed)
+        show_delete_all = bool(existing_files) or sql_has_rows()
+        return existing_files, show_delete_all
 
-    return render_template(
+    existing_files, show_delete_all = await asyncio.to_thread(scan)
+
+    return await render_template(
         "index.html",
         existing_files=existing_files,
         show_delete_all=show_delete_all
@@ -90,23 +157,25 @@ def index():
 # ============================================================
 
 @app.route("/instructions")
-def instructions():
-    return render_template("instructions.html")
+async def instructions():
+    return await render_template("instructions.html")
 
 # ============================================================
 # WATCHLIST INFO (for popup)
 # ============================================================
 
 @app.route("/watchlist_info", methods=["POST"])
-def watchlist_info():
-    payload = request.get_json(force=True)
+async def watchlist_info():
+    payload = await request.get_json(force=True)
     filename = (payload.get("filename") or "").strip()
     regions = payload.get("regions") or []
 
     if not filename:
         return jsonify({"error": "Missing filename"}), 400
+    if not _is_plain_filename(filename):
+        return jsonify({"error": "Invalid filename"}), 400
 
-    meta = load_watchlist_meta(filename)
+    meta = await asyncio.to_thread(load_watchlist_meta, filename)
     out = {}
 
     for r in regions:
@@ -124,47 +193,28 @@ def watchlist_info():
 # ============================================================
 
 @app.route("/delete/<filename>", methods=["DELETE"])
-def delete_file(filename):
+async def delete_file(filename):
+    if not _is_plain_filename(filename):
+        return "Invalid filename.", 400
+
     csv_path = os.path.join(app.config["UPLOAD_FOLDER"], filename)
-    meta_path = _watchlist_meta_path(filename)
 
-    # 1. Parse the CSV FIRST → extract imdb_ids BEFORE deleting it
-    imdb_ids = []
-    if os.path.exists(csv_path):
-        try:
-            films = parse_imdb_csv(csv_path)
-            imdb_ids = [film["imdb_id"] for film in films]
-        except Exception:
-            pass
+    # 1. Look up this watchlist's imdb_ids, and those also used in OTHER
+    #    watchlists, from the watchlist_ids table
+    imdb_ids, shared_ids = await asyncio.to_thread(lookup_watchlist_ids, filename)
 
-    # 2. Identify imdb_ids also used in OTHER watchlists
-    other_watchlists = [
-        f for f in os.listdir(app.config["UPLOAD_FOLDER"])
-        if f.endswith(".csv") and f != filename
-    ]
+    def remove():
+        # 2. Delete CSV + watchlist rows
+        if os.path.exists(csv_path):
+            os.remove(csv_path)
 
-    shared_ids = set()
-    for wl in other_watchlists:
-        path = os.path.join(app.config["UPLOAD_FOLDER"], wl)
-        try:
-            other_films = parse_imdb_csv(path)
-            other_ids = {film["imdb_id"] for film in other_films}
-            shared_ids |= (set(imdb_ids) & other_ids)
-        except Exception:
-            pass
+        sql_delete_watchlist_ids(filename)
+        sql_delete_watchlist_regions(filename)
 
-    # 3. Delete CSV + meta JSON
-    if os.path.exists(csv_path):
-        os.remove(csv_path)
+        # 3. Delete per-film cache rows NOT shared with other lists
+        sql_delete_many(set(imdb_ids) - shared_ids)
 
-    if os.path.exists(meta_path):
-        os.remove(meta_path)
-
-    # 4. Delete per-film cache JSONs NOT shared with other lists
-    for imdb_id in imdb_ids:
-        if imdb_id in shared_ids:
-            continue
-        sql_delete(imdb_id)
+    await asyncio.to_thread(remove)
 
     return ("", 204)
 
@@ -173,20 +223,16 @@ def delete_file(filename):
 # ============================================================
 
 @app.route("/delete_all", methods=["DELETE"])
-def delete_all():
-    # 1. Delete all CSVs and all metadata JSONs
-    folder = app.config["UPLOAD_FOLDER"]
-    for f in os.listdir(folder):
-        path = os.path.join(folder, f)
-        os.remove(path)
-
-    # 2. Clear SQL cache table
-    import sqlite3
-    conn = sqlite3.connect("cache.db")
-    c = conn.cursor()
-    c.execute("DELETE FROM film_cache")
-    conn.commit()
-    conn.close()
+async def delete_all():
+    def clear():
+        # 1. Delete all uploaded CSVs
+        shutil.rmtree(app.config["UPLOAD_FOLDER"], ignore_errors=True)
+        os.makedirs(app.config["UPLOAD_FOLDER"], exist_ok=True)
+
+        # 2. Clear SQL cache + watchlist tables
+        sql_delete_all()
+
+    await asyncio.to_thread(clear)
 
     return ("", 204)
 
@@ -196,14 +242,17 @@ def delete_all():
 # ============================================================
 
 @app.route("/process", methods=["POST"])
-def process():
+async def process():
+
+    form = await request.form
+    files = await request.files
 
-    selected_name = (request.form.get("existing_file") or "").strip()
+    selected_name = (form.get("existing_file") or "").strip()
 
-    upload = request.files.get("file")
+    upload = files.get("file")
     upload_valid = upload and upload.filename != ""
 
-    regions = request.form.getlist("regions")
+    regions = form.getlist("regions")
     if not regions:
         regions = ["GB"]
 
@@ -213,7 +262,7 @@ def process():
     today_str = date.today().isoformat()
 
     # Is the *uploaded* file the one whose radio is selected?
-    selected_source = request.form.get("selected_source", "existing")
+    selected_source = form.get("selected_source", "existing")
 
     is_new_upload_selected = (
         upload_valid
@@ -236,54 +285,36 @@ def process():
         #   2) See which of those are in other watchlists
         #   3) Save the new CSV (overwrite)
         #   4) Parse the NEW CSV → new_imdb_ids
-        #   5) Delete cache JSONs for imdb_ids that were only in the old list
+        #   5) Delete cached films for imdb_ids that were only in the old list
         #      and not in any other watchlist
         csv_filename = upload.filename
+        if not _is_plain_filename(csv_filename):
+            return "Invalid filename.", 400
         filepath = os.path.join(app.config["UPLOAD_FOLDER"], csv_filename)
 
         old_imdb_ids = []
         ids_in_other_lists = set()
 
         if os.path.exists(filepath):
-            # 1) Read old CSV → old_imdb_ids
-            try:
-                old_films = parse_imdb_csv(filepath)
-                old_imdb_ids = [f["imdb_id"] for f in old_films]
-            except Exception:
-                old_imdb_ids = []
-
-            # 2) Check other watchlists for shared ids
-            other_watchlists = [
-                f for f in os.listdir(app.config["UPLOAD_FOLDER"])
-                if f.endswith(".csv") and f != csv_filename
-            ]
-            for wl in other_watchlists:
-                wl_path = os.path.join(app.config["UPLOAD_FOLDER"], wl)
-                try:
-                    wl_films = parse_imdb_csv(wl_path)
-                    wl_ids = {f["imdb_id"] for f in wl_films}
-                    ids_in_other_lists |= (set(old_imdb_ids) & wl_ids)
-                except Exception:
-                    pass
+            # 1) + 2) Old imdb_ids, and which are shared, from watchlist_ids
+            old_imdb_ids, ids_in_other_lists = await asyncio.to_thread(
+                lookup_watchlist_ids, csv_filename
+            )
 
         # 3) Save the new CSV (overwrite or create)
         os.makedirs(app.config["UPLOAD_FOLDER"], exist_ok=True)
-        upload.save(filepath)
+        await upload.save(filepath)
 
         # 4) Parse the NEW CSV
-        films = parse_imdb_csv(filepath)
+        films = await asyncio.to_thread(parse_imdb_csv, filepath)
         new_ids = {f["imdb_id"] for f in films}
+        await asyncio.to_thread(sql_set_watchlist_ids, csv_filename, new_ids)
 
-        # 5) Delete cache JSONs for imdb_ids that were only in the OLD version
+        # 5) Delete cached films for imdb_ids that were only in the OLD version
         #    of this watchlist and are not used elsewhere and not in new list
-        for imdb_id in old_imdb_ids:
-            if imdb_id in new_ids:
-                continue
-            if imdb_id in ids_in_other_lists:
-                continue
-            film_json = os.path.join("cache", f"{imdb_id}.json")
-            if os.path.exists(film_json):
-                os.remove(film_json)
+        await asyncio.to_thread(
+            sql_delete_many, set(old_imdb_ids) - new_ids - ids_in_other_lists
+        )
 
         # Overwrite metadata completely for this watchlist (fresh regions)
         meta = {"filename": csv_filename, "regions": {}}
@@ -291,33 +322,21 @@ def process():
     else:
         # Using a previously uploaded file, ignore the uploaded file
         csv_filename = selected_name
+        if not _is_plain_filename(csv_filename):
+            return "Invalid filename.", 400
         filepath = os.path.join(app.config["UPLOAD_FOLDER"], csv_filename)
 
         if not os.path.exists(filepath):
             return "Selected file not found.", 400
 
-        films = parse_imdb_csv(filepath)
-        meta = load_watchlist_meta(csv_filename)
         # IMPORTANT: do NOT save the uploaded file here
-        upload_valid = False
-
-        filepath = os.path.join(app.config["UPLOAD_FOLDER"], csv_filename)
-
-        # If a new file was uploaded but not saved yet, save it now
-        if upload_valid and not os.path.exists(filepath):
-            os.makedirs(app.config["UPLOAD_FOLDER"], exist_ok=True)
-            upload.save(filepath)
-
-        if not os.path.exists(filepath):
-            return "Selected file not found.", 400
-
-        films = parse_imdb_csv(filepath)
-        meta = load_watchlist_meta(csv_filename)
+        films = await asyncio.to_thread(parse_imdb_csv, filepath)
+        meta = await asyncio.to_thread(load_watchlist_meta, csv_filename)
 
     # ------------------------------------------------------------
     # Refresh vs cached logic
     # ------------------------------------------------------------
-    refresh_mode = request.form.get("refresh_mode", "auto")  # "refresh" / "use_saved" / "auto"
+    refresh_mode = form.get("refresh_mode", "auto")  # "refresh" / "use_saved" / "auto"
     existing_dates = meta.get("regions", {})
 
     refresh_regions = set()
@@ -342,37 +361,36 @@ def process():
     # ------------------------------------------------------------
     # Build provider data for every film
     # ------------------------------------------------------------
-    results = []
-
-    for film in films:
-        imdb_id = film["imdb_id"]
-        imdb_type = film["type"]
-        providers = {}
-
-        if refresh_regions:
-            fresh = get_providers_fresh(imdb_id, imdb_type, list(refresh_regions), today_str)
-            providers.update(fresh["providers"])
-
-        if cached_regions:
-            cached = get_providers_cached(imdb_id, list(cached_regions))
-            providers.update(cached["providers"])
+    cached_rows = await asyncio.to_thread(
+        sql_load_many, [film["imdb_id"] for film in films]
+    )
 
-        for r in regions:
-            providers.setdefault(r, [])
+    results, cache_rows, failed_regions = await process_all(
+        films,
+        regions,
+        list(refresh_regions),
+        list(cached_regions),
+        today_str,
+        cached_rows
+    )
 
-        film["providers"] = providers
-        results.append(film)
+    # Write every refreshed film back to the cache in one transaction
+    await asyncio.to_thread(sql_save_many, cache_rows)
 
     # ------------------------------------------------------------
     # Update watchlist metadata for refreshed regions
     # ------------------------------------------------------------
+    # Regions where any lookup failed keep their previous date (or none),
+    # so the failed films are fetched again rather than served from cache
+    updated_regions = refresh_regions - failed_regions
+
     if refresh_regions:
         # For overwrite case we already ensured meta has fresh "regions": {}
-        for r in refresh_regions:
+        for r in updated_regions:
             meta["regions"][r] = today_str
-        save_watchlist_meta(csv_filename, meta)
+        await asyncio.to_thread(save_watchlist_meta, csv_filename, meta)
 
-    return render_template(
+    return await render_template(
         "results.html",
         results=results,
         regions=regions,
@@ -1,5 +1,38 @@
 import csv
 
+# Normalise type names a bit
+TYPE_MAP = {
+    "movie": "Movie",
+    "tvSeries": "TV Series",
+    "tvMiniSeries": "TV Mini-Series",
+    "tvEpisode": "TV Episode",
+    "short": "Short",
+    "video": "Video",
+    "tvMovie": "TV Movie"
+}
+
+
+def _field(row, index):
+    """Stripped value of a column, or "" if the column/cell is missing."""
+    if index is None or index >= len(row):
+        return ""
+    return row[index].strip()
+
+
+def _safe_int(s):
+    try:
+        return int(s) if s else None
+    except ValueError:
+        return None
+
+
+def _safe_float(s):
+    try:
+        return float(s) if s else None
+    except ValueError:
+        return None
+
+
 def parse_imdb_csv(file_path):
     """
     Reads the IMDb CSV export and returns a list of film dictionaries.
@@ -8,70 +41,64 @@ def parse_imdb_csv(file_path):
     films = []
 
     with open(file_path, newline='', encoding='utf-8') as csvfile:
-        reader = csv.DictReader(csvfile)
+        reader = csv.reader(csvfile)
+
+        header = next(reader, None)
+        if header is None:
+            return films
+
+        # Column name → index, looked up once rather than per row
+        columns = {name: i for i, name in enumerate(header)}
+        i_const = columns.get("Const")
+        i_title = columns.get("Title")
+        i_type = columns.get("Title Type")
+        i_position = columns.get("Position")
+        i_year = columns.get("Year")
+        i_rating = columns.get("IMDb Rating")
+        i_runtime = columns.get("Runtime (mins)")
+        i_genres = columns.get("Genres")
+        i_directors = columns.get("Directors")
 
         for row in reader:
 
-            imdb_id = row.get("Const", "").strip()
+            imdb_id = _field(row, i_const)
             if not imdb_id:
                 continue  # skip malformed rows
 
-            title = row.get("Title", "").strip()
-            type_raw = row.get("Title Type", "").strip()
-
-            # Normalise type names a bit
-            type_map = {
-                "movie": "Movie",
-                "tvSeries": "TV Series",
-                "tvMiniSeries": "TV Mini-Series",
-                "tvEpisode": "TV Episode",
-                "short": "Short",
-                "video": "Video",
-                "tvMovie": "TV Movie"
-            }
-            type_clean = type_map.get(type_raw, type_raw)
-
-            # Position in the list (used for sorting: recently added)
-            try:
-                position = int(row.get("Position", "").strip())
-            except:
-                position = None
-
-            # Year
-            try:
-                year = int(row.get("Year", "").strip())
-            except:
-                year = None
-
-            # IMDb Rating
-            try:
-                rating = float(row.get("IMDb Rating", "").strip())
-            except:
-                rating = None
-
-            # Runtime (mins)
-            try:
-                runtime = int(row.get("Runtime (mins)", "").strip())
-            except:
-                runtime = None
+            type_raw = _field(row, i_type)
 
             # Genres (split comma-separated)
-            genres_raw = row.get("Genres", "").strip()
+            genres_raw = _field(row, i_genres)
             genres = [g.strip() for g in genres_raw.split(",") if g.strip()] if genres_raw else []
 
-            # Directors
-            directors = row.get("Directors", "").strip()
-
             films.append({
                 "imdb_id": imdb_id,
-                "title": title,
-                "type": type_clean,
-                "position": position,      # ⭐ NEW — used for sorting
-                "year": year,
+                "title": _field(row, i_title),
+                "type": TYPE_MAP.get(type_raw, type_raw),
+                "position": _safe_int(_field(row, i_position)),    # ⭐ NEW — used for sorting
+                "year": _safe_int(_field(row, i_year)),
                 "genres": genres,
-                "rating": rating,
-                "runtime": runtime,
-                "directors": directors
+                "rating": _safe_float(_field(row, i_rating)),
+                "runtime": _safe_int(_field(row, i_runtime)),
+                "directors": _field(row, i_directors)
             })
 
     return films
+
+def parse_imdb_ids(file_path):
+    """
+    Reads only the Const column of an IMDb CSV export and returns the
+    imdb_ids, without building a film dictionary per row.
+    """
+
+    with open(file_path, newline='', encoding='utf-8') as csvfile:
+        reader = csv.reader(csvfile)
+
+        header = next(reader, None)
+        if header is None or "Const" not in header:
+            return []
+
+        i_const = header.index("Const")
+        imdb_ids = (_field(row, i_const) for row in reader)
+        return [imdb_id for imdb_id in imdb_ids if imdb_id]
+
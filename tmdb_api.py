@@ -1,22 +1,69 @@
 import os
-import json
+import atexit
+import logging
+import functools
+import asyncio
 import sqlite3
-import requests
+import threading
+import aiohttp
+import orjson
 from dotenv import load_dotenv
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 API_KEY = os.getenv("TMDB_API_KEY")
 
 DB_PATH = "cache.db"
 
+# Max number of TMDb requests in flight at once
+MAX_CONCURRENCY = 32
+
+# Per-request timeout (seconds), and retries with exponential backoff
+HTTP_TIMEOUT = 5
+HTTP_RETRIES = 3
+HTTP_BACKOFF = 0.3
+
+# Statuses worth retrying (rate limit / transient server errors), and the
+# longest Retry-After we'll honour (seconds)
+HTTP_RETRY_STATUSES = {429, 500, 502, 503, 504}
+HTTP_MAX_RETRY_AFTER = 10
+
+# Max bound parameters per "IN (...)" query (SQLite's variable limit)
+SQL_CHUNK_SIZE = 500
+
 
 # ============================================================
 # 1. Initialize SQLite Database
 # ============================================================
 
+# Serialises writes on the shared connection
+_WRITE_LOCK = threading.Lock()
+
+# Guards the first open, since helpers may be called from worker threads
+_INIT_LOCK = threading.Lock()
+
+
 def init_db():
-    conn = sqlite3.connect(DB_PATH)
+    """
+    The single process-wide connection. Called lazily by every SQL helper;
+    only the first call opens and configures it.
+    """
+    with _INIT_LOCK:
+        return _open_db()
+
+
+@functools.cache
+def _open_db():
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA cache_size=-20000")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA busy_timeout=5000")
+    conn.execute("PRAGMA mmap_size=268435456")
+
     conn.execute("""
         CREATE TABLE IF NOT EXISTS film_cache (
             imdb_id TEXT PRIMARY KEY,
@@ -24,60 +71,249 @@ def init_db():
             providers_json TEXT
         )
     """)
-    conn.commit()
-    conn.close()
 
-init_db()
+    # Every watchlist whose imdb_ids have been indexed (including empty ones)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS watchlists (
+            filename TEXT PRIMARY KEY
+        )
+    """)
+
+    # Which imdb_ids each uploaded watchlist contains (for shared-id checks)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS watchlist_ids (
+            filename TEXT,
+            imdb_id TEXT,
+            PRIMARY KEY (filename, imdb_id)
+        )
+    """)
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS ix_watchlist_ids_imdb ON watchlist_ids (imdb_id)"
+    )
+    # Databases indexed before the watchlists table existed
+    conn.execute(
+        "INSERT OR IGNORE INTO watchlists SELECT DISTINCT filename FROM watchlist_ids"
+    )
+
+    # Date each region was last refreshed, per watchlist
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS watchlist_regions (
+            filename TEXT,
+            region TEXT,
+            last_updated TEXT,
+            PRIMARY KEY (filename, region)
+        )
+    """)
+
+    atexit.register(_close_db, conn)
+    return conn
+
+
+def _close_db(conn):
+    conn.execute("PRAGMA optimize")
+    conn.close()
 
 
 # ============================================================
 # 2. SQL Cache Helpers (replace JSON file cache)
 # ============================================================
 
-def sql_load(imdb_id):
-    """Load TMDb ID + providers info for a film from SQLite."""
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute(
-        "SELECT tmdb_id, providers_json FROM film_cache WHERE imdb_id = ?",
-        (imdb_id,)
-    )
-    row = cur.fetchone()
-    conn.close()
+def sql_load_many(imdb_ids):
+    """
+    Load cache entries for many films in one query per SQL_CHUNK_SIZE ids.
+    Returns {imdb_id: {"tmdb_id": ..., "providers": {...}}}; films with no
+    cache entry are left out.
+    """
+    conn = init_db()
+    imdb_ids = list(dict.fromkeys(imdb_ids))
+    out = {}
 
-    if not row:
-        return None
+    for i in range(0, len(imdb_ids), SQL_CHUNK_SIZE):
+        chunk = imdb_ids[i:i + SQL_CHUNK_SIZE]
+        placeholders = "(" + ",".join("?" * len(chunk)) + ")"
+        rows = conn.execute(
+            "SELECT imdb_id, tmdb_id, providers_json FROM film_cache "
+            f"WHERE imdb_id IN {placeholders}",
+            chunk
+        )
 
-    tmdb_id, providers_json = row
-    providers_block = json.loads(providers_json) if providers_json else {}
+        for imdb_id, tmdb_id, providers_json in rows:
+            out[imdb_id] = {
+                "tmdb_id": tmdb_id,
+                "providers": orjson.loads(providers_json) if providers_json else {}
+            }
+
+    return out
+
+
+def sql_save_many(rows):
+    """
+    Insert or update many film cache entries in a single transaction.
+    rows: [(imdb_id, tmdb_id, providers_json), ...]
+    """
+    conn = init_db()
+    if not rows:
+        return
+
+    with _WRITE_LOCK:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany(
+                "INSERT OR REPLACE INTO film_cache (imdb_id, tmdb_id, providers_json) "
+                "VALUES (?, ?, ?)",
+                rows
+            )
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+
+def sql_delete_many(imdb_ids):
+    """Delete many films' cache entries in a single transaction."""
+    if not imdb_ids:
+        return
+
+    conn = init_db()
+    with _WRITE_LOCK:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany(
+                "DELETE FROM film_cache WHERE imdb_id = ?",
+                [(imdb_id,) for imdb_id in imdb_ids]
+            )
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+
+def sql_has_rows():
+    """Whether any film is cached; one index probe rather than a COUNT(*)."""
+    conn = init_db()
+    return conn.execute("SELECT 1 FROM film_cache LIMIT 1").fetchone() is not None
+
+
+def sql_delete_all():
+    """Clear every cached film and all watchlist data (used by app.py)."""
+    conn = init_db()
+    with _WRITE_LOCK:
+        conn.execute("DELETE FROM film_cache")
+        conn.execute("DELETE FROM watchlists")
+        conn.execute("DELETE FROM watchlist_ids")
+        conn.execute("DELETE FROM watchlist_regions")
+        # Give the freed pages back to the filesystem. Best-effort: VACUUM
+        # fails while another thread's read on the shared connection is
+        # still in progress, and the rows are already gone either way.
+        try:
+            conn.execute("VACUUM")
+        except sqlite3.OperationalError as e:
+            logger.warning("VACUUM skipped: %s", e)
 
-    return {
-        "tmdb_id": tmdb_id,
-        "providers": providers_block
-    }
 
+# ============================================================
+# 3. Watchlist Index Helpers
+# ============================================================
 
-def sql_save(imdb_id, data):
-    """Insert or update film cache entry in SQLite."""
-    tmdb_id = data.get("tmdb_id")
-    providers_block = data.get("providers", {})
+def sql_indexed_watchlists():
+    """Filenames of every watchlist whose imdb_ids have been recorded."""
+    conn = init_db()
+    rows = conn.execute("SELECT filename FROM watchlists")
+    return {filename for (filename,) in rows}
 
-    conn = sqlite3.connect(DB_PATH)
-    conn.execute(
-        "INSERT OR REPLACE INTO film_cache (imdb_id, tmdb_id, providers_json) "
-        "VALUES (?, ?, ?)",
-        (imdb_id, tmdb_id, json.dumps(providers_block))
+
+def sql_watchlist_ids(filename):
+    """imdb_ids recorded for a watchlist."""
+    conn = init_db()
+    rows = conn.execute(
+        "SELECT imdb_id FROM watchlist_ids WHERE filename = ?", (filename,)
     )
-    conn.commit()
-    conn.close()
+    return [imdb_id for (imdb_id,) in rows]
 
 
-def sql_delete(imdb_id):
-    """Delete a single film's cache entry (used by app.py)."""
-    conn = sqlite3.connect(DB_PATH)
-    conn.execute("DELETE FROM film_cache WHERE imdb_id = ?", (imdb_id,))
-    conn.commit()
-    conn.close()
+def sql_shared_ids(filename):
+    """imdb_ids in this watchlist that also appear in any other watchlist."""
+    conn = init_db()
+    rows = conn.execute(
+        "SELECT DISTINCT imdb_id FROM watchlist_ids "
+        "WHERE filename != ? AND imdb_id IN "
+        "(SELECT imdb_id FROM watchlist_ids WHERE filename = ?)",
+        (filename, filename)
+    )
+    return {imdb_id for (imdb_id,) in rows}
+
+
+def sql_set_watchlist_ids(filename, imdb_ids):
+    """Replace the recorded imdb_ids for a watchlist in one transaction."""
+    conn = init_db()
+    with _WRITE_LOCK:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                "INSERT OR IGNORE INTO watchlists (filename) VALUES (?)", (filename,)
+            )
+            conn.execute("DELETE FROM watchlist_ids WHERE filename = ?", (filename,))
+            conn.executemany(
+                "INSERT OR IGNORE INTO watchlist_ids (filename, imdb_id) VALUES (?, ?)",
+                [(filename, imdb_id) for imdb_id in imdb_ids]
+            )
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+
+def sql_delete_watchlist_ids(filename):
+    """Forget a watchlist's recorded imdb_ids (used by app.py)."""
+    conn = init_db()
+    with _WRITE_LOCK:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("DELETE FROM watchlists WHERE filename = ?", (filename,))
+            conn.execute("DELETE FROM watchlist_ids WHERE filename = ?", (filename,))
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+
+# ============================================================
+# 4. Watchlist Region Date Helpers
+# ============================================================
+
+def sql_load_watchlist_regions(filename):
+    """{region: last_updated} for a watchlist."""
+    conn = init_db()
+    rows = conn.execute(
+        "SELECT region, last_updated FROM watchlist_regions WHERE filename = ?",
+        (filename,)
+    )
+    return dict(rows)
+
+
+def sql_save_watchlist_regions(filename, regions):
+    """Replace a watchlist's {region: last_updated} in one transaction."""
+    conn = init_db()
+    with _WRITE_LOCK:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("DELETE FROM watchlist_regions WHERE filename = ?", (filename,))
+            conn.executemany(
+                "INSERT OR REPLACE INTO watchlist_regions (filename, region, last_updated) "
+                "VALUES (?, ?, ?)",
+                [(filename, region, day) for region, day in regions.items()]
+            )
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+
+def sql_delete_watchlist_regions(filename):
+    """Forget a watchlist's region dates (used by app.py)."""
+    conn = init_db()
+    with _WRITE_LOCK:
+        conn.execute("DELETE FROM watchlist_regions WHERE filename = ?", (filename,))
 
 
 # ============================================================
@@ -100,16 +336,51 @@ def imdb_type_to_tmdb_type(imdb_type):
     return "movie"
 
 
+# ============================================================
+# TMDb HTTP Helper
+# ============================================================
+
+def _retry_after(headers, default):
+    """Seconds to wait from a Retry-After header, else default."""
+    try:
+        return min(max(float(headers.get("Retry-After")), 0), HTTP_MAX_RETRY_AFTER)
+    except (TypeError, ValueError):
+        return default
+
+
+async def _get_json(session, url):
+    """
+    GET a TMDb URL and parse the body with orjson, retrying with backoff on
+    connection errors, timeouts, 429 and 5xx (honouring Retry-After).
+    Raises aiohttp.ClientResponseError on any other error status, or once
+    the retries are used up.
+    """
+    for attempt in range(HTTP_RETRIES + 1):
+        delay = HTTP_BACKOFF * 2 ** attempt
+        try:
+            async with session.get(url) as resp:
+                resp.raise_for_status()
+                return orjson.loads(await resp.read())
+        except aiohttp.ClientResponseError as e:
+            if e.status not in HTTP_RETRY_STATUSES or attempt == HTTP_RETRIES:
+                raise
+            delay = _retry_after(e.headers or {}, delay)
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            if attempt == HTTP_RETRIES:
+                raise
+        await asyncio.sleep(delay)
+
+
 # ============================================================
 # TMDb Find Endpoint → Get TMDb ID
 # ============================================================
 
-def get_tmdb_id(imdb_id):
+async def get_tmdb_id(session, imdb_id):
     url = (
         f"https://api.themoviedb.org/3/find/{imdb_id}"
         f"?api_key={API_KEY}&external_source=imdb_id"
     )
-    r = requests.get(url).json()
+    r = await _get_json(session, url)
 
     movie_results = r.get("movie_results", [])
     tv_results = r.get("tv_results", [])
@@ -126,21 +397,34 @@ def get_tmdb_id(imdb_id):
 # TMDb Provider Lookup
 # ============================================================
 
-def get_watch_providers(tmdb_id, media_type, region):
+async def get_watch_providers(session, tmdb_id, media_type, regions):
+    """
+    TMDb returns every region in a single response, so one request covers
+    all requested regions. Returns {region: [provider names]}.
+    """
     if tmdb_id is None:
-        return []
+        return {region: [] for region in regions}
 
     url = (
         f"https://api.themoviedb.org/3/{media_type}/{tmdb_id}/watch/providers"
         f"?api_key={API_KEY}"
     )
-    r = requests.get(url).json()
-
     try:
-        providers = r["results"][region]["flatrate"]
-        return [p["provider_name"] for p in providers]
-    except Exception:
-        return []
+        r = await _get_json(session, url)
+    except aiohttp.ClientResponseError as e:
+        if e.status != 404:
+            raise
+        r = {}  # unknown TMDb ID → no providers
+
+    out = {}
+    for region in regions:
+        try:
+            providers = r["results"][region]["flatrate"]
+            out[region] = [p["provider_name"] for p in providers]
+        except Exception:
+            out[region] = []
+
+    return out
 
 
 # ============================================================
@@ -159,30 +443,32 @@ def _extract_entry(entry):
             "last_updated": "2025-01-12",
             "names": ["Netflix", "MUBI"]
         }
+
+    Missing names come back as an empty tuple, so no list is allocated.
     """
-    if entry is None:
-        return None, []
+    t = type(entry)
 
-    if isinstance(entry, list):
-        return None, entry
+    if t is dict:
+        return entry.get("last_updated"), entry.get("names") or ()
 
-    if isinstance(entry, dict):
-        return entry.get("last_updated"), entry.get("names", [])
+    if t is list:
+        return None, entry
 
-    return None, []
+    return None, ()
 
 
 # ============================================================
 # Public API — Cached Providers
 # ============================================================
 
-def get_providers_cached(imdb_id, regions):
-    cached = sql_load(imdb_id)
+def get_providers_cached(regions, cached_row=None):
+    """cached_row is this film's entry from sql_load_many (None if uncached)."""
+    cached = cached_row
 
     if not cached:
         return {
             "tmdb_id": None,
-            "providers": {region: [] for region in regions}
+            "providers": {region: () for region in regions}
         }
 
     providers_block = cached.get("providers", {})
@@ -200,54 +486,110 @@ def get_providers_cached(imdb_id, regions):
 
 
 # ============================================================
-# Public API — Fresh Providers
+# Public API — Whole Watchlist
 # ============================================================
 
-def get_providers_fresh(imdb_id, imdb_type, regions, today_str):
-    cached = sql_load(imdb_id) or {}
-    tmdb_id = cached.get("tmdb_id")
-    providers_block = cached.get("providers", {})
-
-    # Determine if we need the TMDb ID at all
-    need_any_fetch = False
-    for region in regions:
-        entry = providers_block.get(region)
-        last_updated, _ = _extract_entry(entry)
-        if last_updated != today_str:
-            need_any_fetch = True
-            break
-
-    if need_any_fetch and tmdb_id is None:
-        tmdb_id = get_tmdb_id(imdb_id)
-        cached["tmdb_id"] = tmdb_id
-
-    media_type = imdb_type_to_tmdb_type(imdb_type)
-    results = {}
-
-    for region in regions:
-        entry = providers_block.get(region)
-        last_updated, names = _extract_entry(entry)
+async def process_all(films, regions, refresh_regions, cached_regions, today_str,
+                      cached_rows):
+    """
+    Attach a "providers" dict to every film. Regions in refresh_regions are
+    fetched from TMDb (concurrently, bounded by MAX_CONCURRENCY) unless
+    already updated today; regions in cached_regions are read from
+    cached_rows (the sql_load_many result).
+
+    Films whose TMDb lookup fails are served from cached_rows and left out
+    of the returned cache rows; the regions they were due a refresh in are
+    returned as failed_regions, so the caller doesn't mark those regions
+    as up to date.
+
+    Returns (films in input order, cache rows for sql_save_many,
+    failed_regions).
+    """
+    # 1. One pass over the films: which regions are stale for which film.
+    #    Films listed twice are only fetched once.
+    stale = {}  # imdb_id -> (media_type, [regions])
 
-        if last_updated == today_str:
-            results[region] = names
+    for film in films:
+        imdb_id = film["imdb_id"]
+        if imdb_id in stale:
             continue
 
-        if tmdb_id is None:
-            names = []
-        else:
-            names = get_watch_providers(tmdb_id, media_type, region)
-
-        providers_block[region] = {
-            "last_updated": today_str,
-            "names": names
-        }
-        results[region] = names
-
-    cached["providers"] = providers_block
-    sql_save(imdb_id, cached)
-
-    return {
-        "tmdb_id": tmdb_id,
-        "providers": results
-    }
-
+        row = cached_rows.get(imdb_id)
+        providers_block = row["providers"] if row else {}
+        stale_regions = [
+            region for region in refresh_regions
+            if _extract_entry(providers_block.get(region))[0] != today_str
+        ]
+        if stale_regions:
+            stale[imdb_id] = (imdb_type_to_tmdb_type(film["type"]), stale_regions)
+
+    # 2. Fetch exactly that set; /find is only called for films without a
+    #    cached TMDb ID
+    fetched = {}
+    failed_regions = set()
+
+    if stale:
+        semaphore = asyncio.Semaphore(MAX_CONCURRENCY)
+        connector = aiohttp.TCPConnector(limit=MAX_CONCURRENCY)
+        timeout = aiohttp.ClientTimeout(total=HTTP_TIMEOUT)
+
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+
+            async def fetch(imdb_id, media_type, stale_regions):
+                row = cached_rows.get(imdb_id)
+                tmdb_id = row["tmdb_id"] if row else None
+
+                async with semaphore:
+                    if tmdb_id is None:
+                        tmdb_id = await get_tmdb_id(session, imdb_id)
+                    names = await get_watch_providers(
+                        session, tmdb_id, media_type, stale_regions
+                    )
+                return imdb_id, tmdb_id, names
+
+            results = await asyncio.gather(
+                *(fetch(imdb_id, *job) for imdb_id, job in stale.items()),
+                return_exceptions=True
+            )
+
+        # A film whose fetch failed keeps its cached data (if any) and is
+        # not written back; its regions are reported as failed
+        for imdb_id, result in zip(stale, results):
+            if isinstance(result, BaseException):
+                logger.warning("TMDb lookup failed for %s: %r", imdb_id, result)
+                failed_regions.update(stale[imdb_id][1])
+                continue
+            _, tmdb_id, names = result
+            fetched[imdb_id] = (tmdb_id, names)
+
+    # 3. Merge fetched regions into the cache rows
+    rows = dict(cached_rows)
+    cache_rows = []
+
+    for imdb_id, (tmdb_id, names_by_region) in fetched.items():
+        row = cached_rows.get(imdb_id)
+        providers_block = dict(row["providers"]) if row else {}
+
+        for region, names in names_by_region.items():
+            providers_block[region] = {
+                "last_updated": today_str,
+                "names": names
+            }
+
+        rows[imdb_id] = {"tmdb_id": tmdb_id, "providers": providers_block}
+        cache_rows.append((imdb_id, tmdb_id, orjson.dumps(providers_block).decode()))
+
+    # 4. Attach providers to every film
+    wanted = list(refresh_regions) + list(cached_regions)
+
+    for film in films:
+        providers = get_providers_cached(
+            wanted, cached_row=rows.get(film["imdb_id"])
+        )["providers"]
+
+        for r in regions:
+            providers.setdefault(r, [])
+
+        film["providers"] = providers
+
+    return films, cache_rows, failed_regions